@@ -3,18 +3,174 @@
 # pyright: reportMissingImports=false
 
 import subprocess
+import shlex
 import logging
 import time
 import os
+import mmap
+import threading
+from functools import cached_property
 from pyslurmlite import (
     remove_existing_file_handlers,
     dict_to_args_list,
-    run_shell_command
+    run_shell_command_stream
 )
 
 # set up module level logging
 logger = logging.getLogger('SlurmBatchJob')
 logger.setLevel(logging.INFO)
+_FORMATTER = logging.Formatter(
+    '|%(asctime)s|%(name)s|%(levelname)s\n%(message)s\n')
+# shared by all jobs without a logfile
+_stream_handler = logging.StreamHandler()
+_stream_handler.setFormatter(_FORMATTER)
+
+# states in which a job is still queued or running
+ACTIVE_STATES = ['PENDING', 'RUNNING', 'CONFIGURING', 'COMPLETING']
+
+# slurm output is decoded as utf-8 rather than with the locale's encoding
+_CAPTURE_TEXT = dict(capture_output=True, text=True, encoding='utf-8', errors='replace')
+
+
+def _run_command(argv):
+    """run a command without a shell and return its stdout"""
+    return subprocess.run(argv, **_CAPTURE_TEXT).stdout
+
+
+def _sbatch(argv):
+    """submit a job with sbatch, returning the response and the job id"""
+    result = subprocess.run(argv, check=False, **_CAPTURE_TEXT)
+    if result.stderr:
+        logger.warning(f'sbatch stderr: {result.stderr}')
+    sbatch_response = result.stdout
+    # response is "Submitted batch job <id>", or empty if submission failed
+    job_id = sbatch_response.rpartition(' ')[2].strip()
+    return sbatch_response, job_id or None
+
+
+class _StatusCache:
+    """
+    Shared cache of job states, fed by a single background squeue stream
+
+    One `squeue --me -i <interval>` process is shared by all waiting jobs,
+    so the number of squeue calls does not grow with the number of jobs.
+    Waiters are woken whenever the stream shows their job out of the
+    queue or in a non-active state, and the stream is stopped once the
+    last waiter is released.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._states = {}
+        self._events = {}
+        self._waiters = 0
+        self._process = None
+        self._thread = None
+
+    def running(self):
+        return self._process is not None and self._thread.is_alive()
+
+    def start(self, job_id, interval=30):
+        """register a waiter, launching the squeue stream if needed"""
+        with self._lock:
+            self._waiters += 1
+            # registered before the waiter first reads the cache, so that
+            # a job leaving the queue in between still wakes it
+            self._events.setdefault(job_id, threading.Event())
+            if self.running():
+                return
+            # the header line marks the start of each iteration,
+            # and -r lists array tasks one per line
+            try:
+                self._process = subprocess.Popen(
+                    ['squeue', '--me', '-r', '-i', str(interval), '--format=%i,%T'],
+                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                    text=True, encoding='utf-8', errors='replace')
+            except OSError as e:
+                logger.warning(f'Could not start squeue stream: {e}')
+                self._process = None
+                return
+            self._thread = threading.Thread(
+                target=self._read_stream, args=(self._process,), daemon=True)
+            self._thread.start()
+
+    def release(self, job_id):
+        """unregister a waiter, stopping the squeue stream if it was the last"""
+        with self._lock:
+            self._events.pop(job_id, None)
+            self._waiters = max(self._waiters - 1, 0)
+            if self._waiters == 0 and self._process is not None:
+                self._process.terminate()
+                self._process = None
+                self._states = {}
+
+    def _read_stream(self, process):
+        # each iteration is a header line, one line per job and a blank line
+        snapshot = None
+        for line in process.stdout:
+            line = line.strip()
+            if line.upper().startswith('JOBID'):
+                if snapshot is not None:
+                    self._update(process, snapshot)
+                snapshot = {}
+            elif not line:
+                if snapshot is not None:
+                    self._update(process, snapshot)
+                snapshot = None
+            elif snapshot is not None:
+                job_id, _, state = line.partition(',')
+                snapshot[job_id] = state.upper()
+        if snapshot is not None:
+            self._update(process, snapshot)
+        process.stdout.close()
+        process.wait()
+        # stream ended - forget everything and release the waiters,
+        # who fall back to querying slurm directly
+        with self._lock:
+            if process is not self._process:
+                return
+            self._process = None
+            self._states = {}
+            for event in self._events.values():
+                event.set()
+            self._events.clear()
+
+    def _update(self, process, snapshot):
+        with self._lock:
+            if process is not self._process:
+                return
+            for job_id, event in self._events.items():
+                if job_id not in snapshot or not any(
+                        i in snapshot[job_id] for i in ACTIVE_STATES):
+                    event.set()
+            self._states = snapshot
+
+    def get(self, job_id):
+        """return the cached state of a job, or None if it is not in the queue"""
+        with self._lock:
+            return self._states.get(job_id)
+
+    def wait(self, job_id, timeout):
+        """block until the job finishes or the timeout expires"""
+        with self._lock:
+            if not self.running():
+                event = None
+            else:
+                event = self._events.setdefault(job_id, threading.Event())
+        if event is None:
+            time.sleep(timeout)
+        else:
+            # a wakeup that arrives after this clear is kept for the next
+            # wait; one that arrived before it is already in the cache,
+            # which the waiter reads again before waiting
+            event.wait(timeout)
+            event.clear()
+
+
+_status_cache = _StatusCache()
+
+# number of jobs sharing each file handler attached to the module logger
+_file_handler_users = {}
 
 
 class SlurmBatchJob:
@@ -54,6 +210,7 @@ class SlurmBatchJob:
         self.local_response = None
         self.local_run = False
         self.sbatch_run = False
+        self._fh = None
 
         # first remove any outside file logger
         self.saved_handlers = remove_existing_file_handlers()
@@ -63,24 +220,29 @@ class SlurmBatchJob:
         elif 'logfile' in user_args:
             self.logfile = user_args['logfile']
 
-        logger.setLevel(logging.DEBUG if self.verbose else logging.INFO)
-        formatter = logging.Formatter(
-            '|%(asctime)s|%(name)s|%(levelname)s\n%(message)s\n')
+        # setLevel clears the cache of every logger, so only call it on a change
+        level = logging.DEBUG if self.verbose else logging.INFO
+        if logger.level != level:
+            logger.setLevel(level)
         if self.logfile is not None:
-            self.logdir = os.path.dirname(os.path.realpath(self.logfile))
-            if not os.path.exists(self.logdir):
-                os.makedirs(self.logdir)
-            fh = logging.FileHandler(self.logfile)
-            fh.setFormatter(formatter)
-            logger.addHandler(fh)
-            logger.debug(f'log file: {self.logfile}')
+            logpath = os.path.realpath(self.logfile)
+            self.logdir = os.path.dirname(logpath)
+            os.makedirs(self.logdir, exist_ok=True)
+            # reuse the handler of an earlier job logging to the same file
+            self._fh = next(
+                (h for h in logger.handlers if isinstance(h, logging.FileHandler)
+                 and os.path.realpath(h.baseFilename) == logpath),
+                None)
+            if self._fh is None:
+                self._fh = logging.FileHandler(self.logfile)
+                self._fh.setFormatter(_FORMATTER)
+                logger.addHandler(self._fh)
+            _file_handler_users[self._fh] = _file_handler_users.get(self._fh, 0) + 1
+            logger.debug('log file: %s', self.logfile)
         else:
-            sh = logging.StreamHandler()
-            sh.setFormatter(formatter)
-            logger.addHandler(sh)
+            logger.addHandler(_stream_handler)
             logger.debug('No logfile specified')
 
-        assert os.path.exists(self.script)
         logger.info(f'Setting up SlurmBatchJob for {self.script}')
 
         self.default_args = {
@@ -93,58 +255,171 @@ class SlurmBatchJob:
         }
 
         self.setup_args(user_args, kwargs)
-        logger.debug(f'args: {self.args}')
+        logger.debug('args: %s', self.args)
 
-        self.command = (
+    @cached_property
+    def command(self):
+        """command line that runs the script, built on first use"""
+        command = (
             f"{self.args['module_string']}"
             f"python3 {self.script} {' '.join(dict_to_args_list(self.args))}"
         )
-        logger.debug(f'command: {self.command}')
-
-        self.sbatch_command = (
-            f"sbatch -J {jobname} -o {self.logfile} --wrap='{self.command}' "
-            f"--nice={self.args['nice']} {self.args['node_cmd']} --open-mode=append "
-            f"--cpus-per-task={self.args['cores']} --partition={self.args['partition']} "
-            f"-e {self.logfile} "
-            f"-t {self.args['time_hours']}:00:00"
-        )
-        logger.debug(f'sbatch_command: {self.sbatch_command}')
+        logger.debug('command: %s', command)
+        return command
+
+    @cached_property
+    def sbatch_argv(self):
+        """argv used to submit the job with sbatch"""
+        return [
+            'sbatch', '-J', self.jobname,
+            # without -e, sbatch sends stderr to the -o file
+            '-o', str(self.logfile),
+            '--wrap', self.command,
+            *self._resource_args(),
+        ]
+
+    @cached_property
+    def sbatch_command(self):
+        """sbatch command as a single string, for display"""
+        sbatch_command = shlex.join(self.sbatch_argv)
+        logger.debug('sbatch_command: %s', sbatch_command)
+        return sbatch_command
 
     def setup_args(self, user_args, kwargs):
-        # extend default args with user args and kwargs
-        self.args = self.default_args
-        if isinstance(user_args, dict):
-            self.args = self.default_args
-            self.args.update(user_args)
-        elif user_args is not None:
+        # extend default args with user args and kwargs,
+        # without modifying the defaults
+        if user_args is not None and not isinstance(user_args, dict):
             raise TypeError('args must be dict or None')
-
-        self.args.update(kwargs)
+        self.args = {**self.default_args, **(user_args or {}), **kwargs}
+
+    def _resource_args(self):
+        """sbatch options describing the resources requested for the job"""
+        return [
+            f"--nice={self.args['nice']}",
+            *shlex.split(self.args['node_cmd']),
+            '--open-mode=append',
+            f"--cpus-per-task={self.args['cores']}",
+            f"--partition={self.args['partition']}",
+            '-t', f"{self.args['time_hours']}:00:00",
+        ]
+
+    def _check_script(self):
+        # checked at submission rather than construction, so that setting up
+        # a job does not touch the filesystem
+        if not os.path.exists(self.script):
+            raise FileNotFoundError(f'Script not found: {self.script}')
 
     def run(self):
         if self.local:
             self.run_local()
+            return
 
-        sbatch_response = subprocess.getoutput(self.sbatch_command)
-        setattr(self, 'job_id', sbatch_response.split(" ")[-1].strip())
-        logger.debug(f'job_id: {self.job_id}')
+        self._check_script()
+        sbatch_response, job_id = _sbatch(self.sbatch_argv)
+        setattr(self, 'job_id', job_id)
+        logger.debug('job_id: %s', self.job_id)
         if self.job_id is not None:
             self.sbatch_run = True
         setattr(self, 'sbatch_response', sbatch_response)
-        logger.debug(f'sbatch_response: {self.sbatch_response}')
+        logger.debug('sbatch_response: %s', self.sbatch_response)
+
+    @classmethod
+    def run_many(cls, jobs):
+        """
+        Submit many jobs, coalescing jobs with the same script and
+        resources into a single job array
+
+        Each array task runs the command of one job, appending its output
+        to that job's logfile, so the jobs can be waited on as usual.
+        Jobs without a logfile write to <jobname>_<arrayid>_<task>.log in
+        the log directory of the first job in their group.
+
+        Parameters
+        ----------
+        jobs : list
+            SlurmBatchJob instances to submit
+        """
+        groups = {}
+        for job in jobs:
+            if job.local:
+                job.run_local()
+                continue
+            key = (job.script, job.args['cores'], job.args['partition'],
+                   job.args['time_hours'], job.args['node_cmd'], job.args['nice'])
+            groups.setdefault(key, []).append(job)
+
+        for group in groups.values():
+            if len(group) == 1:
+                group[0].run()
+                continue
+
+            for job in group:
+                job._check_script()
+            first = group[0]
+
+            # the task commands are embedded in the batch script itself,
+            # so no task file is left behind after the array finishes
+            wrap = ['case "$SLURM_ARRAY_TASK_ID" in']
+            for idx, job in enumerate(group):
+                line = job.command
+                if job.logfile is not None:
+                    line += f' >> {shlex.quote(job.logfile)} 2>&1'
+                wrap.append(f'{idx}) {line} ;;')
+            wrap.append('esac')
+
+            # only jobs without a logfile need the array's own output
+            if all(job.logfile is not None for job in group):
+                array_log = os.devnull
+            else:
+                logdir = first.logdir if first.logdir is not None else os.getcwd()
+                array_log = os.path.join(logdir, f'{first.jobname}_%A_%a.log')
+
+            sbatch_argv = [
+                'sbatch', f'--array=0-{len(group) - 1}', '-J', first.jobname,
+                '-o', array_log,
+                '--wrap', '\n'.join(wrap),
+                *first._resource_args(),
+            ]
+            sbatch_response, master_id = _sbatch(sbatch_argv)
+            logger.debug('array job_id: %s', master_id)
+            if master_id is None:
+                continue
+            for idx, job in enumerate(group):
+                setattr(job, 'job_id', f'{master_id}_{idx}')
+                setattr(job, 'sbatch_response', sbatch_response)
+                job.sbatch_run = True
 
     def run_local(self):
         """run without slurm"""
         logger.info(f'Running job locally: {self.jobname}')
+        self._check_script()
         setattr(self, 'job_id', None)
         logger.info(f'command: {self.command}')
-        response = subprocess.run(self.command, shell=True)
+        if self.args['module_string']:
+            # module commands need to be interpreted by the shell
+            response = subprocess.run(self.command, shell=True)
+        else:
+            response = subprocess.run(shlex.split(self.command))
         setattr(self, 'local_response', response)
         logger.info(f'response: {response}')
         if response is not None:
             setattr(self, 'local_run', True)
 
-    def wait(self, wait_time=30):
+    def wait(self, wait_time=30, as_mmap=False):
+        """
+        Wait for the job to finish and return the contents of its logfile
+
+        Parameters
+        ----------
+        wait_time : int
+            maximum number of seconds between status checks
+        as_mmap : bool
+            return the logfile as a read-only mmap rather than a str,
+            which avoids reading and decoding large logs; the caller owns
+            the mapping and must close() it. An empty logfile cannot be
+            mapped and is returned as b'' instead, so the result is
+            either an mmap.mmap or bytes
+        """
         if self.local:
             logger.warning('Cannot wait for local job - returning output from local job')
             return(self.local_response)
@@ -152,27 +427,48 @@ class SlurmBatchJob:
         if not self.sbatch_run:
             logger.warning('Cannot wait for job - job not run')
 
+        _status_cache.start(self.job_id, wait_time)
+        try:
+            return self._wait_for_completion(wait_time, as_mmap)
+        finally:
+            _status_cache.release(self.job_id)
+
+    def _wait_for_completion(self, wait_time, as_mmap):
         while True:
             status = self.status()
             if status is not None:
                 # check to see whether the job is still running, if so then wait and continue
-                if any(i in status for i in ['PENDING', 'RUNNING', 'CONFIGURING']):
-                    logger.debug(f'Job {self.job_id} still running with status {status}')
-                    time.sleep(wait_time)
+                if any(i in status for i in ACTIVE_STATES):
+                    logger.debug('Job %s still running with status %s', self.job_id, status)
+                    _status_cache.wait(self.job_id, wait_time)
                     continue
-                logger.debug(f'Job {self.job_id} breaking with status {status}')
+                logger.debug('Job %s breaking with status %s', self.job_id, status)
                 status = self.status(return_full_output=True)
                 logger.info(f'Job {self.job_id} finished with status: {status}\n\n')
-                logger.debug(f'reading log_file: {self.logfile}')
+                logger.debug('reading log_file: %s', self.logfile)
                 try:
-                    with open(self.logfile, "r") as f:
-                        output = f.read()
+                    output = self._read_logfile(as_mmap)
                 except FileNotFoundError:
                     logger.warning(f'Could not find log file: {self.logfile}')
                     output = None
                 return output
             else:
-                time.sleep(wait_time)
+                _status_cache.wait(self.job_id, wait_time)
+
+    def _read_logfile(self, as_mmap=False):
+        if not as_mmap:
+            with open(self.logfile, "r") as f:
+                return f.read()
+
+        fd = os.open(self.logfile, os.O_RDONLY)
+        try:
+            if os.fstat(fd).st_size == 0:
+                # empty files cannot be mapped
+                return b''
+            return mmap.mmap(fd, 0, prot=mmap.PROT_READ)
+        finally:
+            # the mapping stays valid after the descriptor is closed
+            os.close(fd)
 
     def status(self, return_full_output=False):
         if self.local:
@@ -185,28 +481,152 @@ class SlurmBatchJob:
             logger.warning('Cannot get status of job - job not run')
             return None
 
-        temp = subprocess.getoutput(
-            f"sacct -n -P -j {self.job_id} --noconvert --format=State,Elapsed,MaxRSS,NCPUS,JobName"
-        )
-
-        status = None if temp == "" else temp.split("\n")[0].split("|")[0].upper()
+        # squeue only queries the controller, so prefer it while the job is queued;
+        # fall back to sacct (which hits slurmdbd) once the job has left the queue
+        if not return_full_output:
+            state = _status_cache.get(self.job_id)
+            if state is not None:
+                return state
+            state = _run_command(
+                ['squeue', '-h', '-j', self.job_id, '-o', '%T']).strip()
+            if state:
+                return state.upper()
+
+        temp = _run_command(
+            ['sacct', '-n', '-P', '-j', self.job_id, '--noconvert',
+             '--format=State,Elapsed,MaxRSS,NCPUS,JobName']
+        ).strip()
+
+        # state is the first field of the first line
+        first_line, _, _ = temp.partition('\n')
+        state, _, _ = first_line.partition('|')
+        status = state.upper() if state else None
 
         return temp if return_full_output else status
 
+    def close(self):
+        """detach the job's file handler, closing it if no other job uses it"""
+        fh = getattr(self, '_fh', None)
+        if fh is None:
+            return
+        self._fh = None
+        users = _file_handler_users.pop(fh, 1) - 1
+        if users > 0:
+            _file_handler_users[fh] = users
+        else:
+            logger.removeHandler(fh)
+            fh.close()
+
+    def __del__(self):
+        self.close()
+
     @staticmethod
     def disable_loggers():
-        for h in logger.handlers:
+        for h in list(logger.handlers):
             if isinstance(h, logging.FileHandler):
                 logger.removeHandler(h)
+                # jobs must not reuse a handler that is no longer attached
+                _file_handler_users.pop(h, None)
+
+
+class JobPool:
+    def __init__(self, wait_time=30):
+        """
+        Submit a set of jobs and wait for all of them to finish
+
+        All jobs in the pool are tracked through the shared squeue stream,
+        so waiting on N jobs takes as long as the slowest job rather than
+        the sum of the jobs.
+
+        Parameters
+        ----------
+        wait_time : int
+            maximum number of seconds between status checks
+        """
+        self.wait_time = wait_time
+        self.jobs = []
+
+    def submit(self, job):
+        """run a SlurmBatchJob and add it to the pool"""
+        if job.local:
+            job.run_local()
+        else:
+            job.run()
+        self.jobs.append(job)
+        return job
+
+    def wait_all(self, timeout=None):
+        """
+        Wait for all jobs in the pool to finish
+
+        Parameters
+        ----------
+        timeout : float
+            maximum number of seconds to wait (default: no limit)
+
+        Returns a dict mapping each finished job to its full sacct output
+        (or its local response for local jobs); jobs still running when
+        the timeout expires are left out.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        results = {}
+        waiting = []
+        for job in self.jobs:
+            if job.local:
+                results[job] = job.local_response
+            elif not job.sbatch_run:
+                logger.warning(f'Cannot wait for job {job.jobname} - job not run')
+                results[job] = None
+            else:
+                _status_cache.start(job.job_id, self.wait_time)
+                waiting.append(job)
+
+        try:
+            # all jobs are followed by the same stream, so waiting on them
+            # in turn returns once the slowest one is done
+            for job in waiting:
+                while True:
+                    status = job.status()
+                    if status is not None and not any(i in status for i in ACTIVE_STATES):
+                        results[job] = job.status(return_full_output=True)
+                        break
+                    wait_time = self.wait_time
+                    if deadline is not None:
+                        wait_time = min(wait_time, deadline - time.monotonic())
+                        if wait_time <= 0:
+                            return results
+                    _status_cache.wait(job.job_id, wait_time)
+        finally:
+            for job in waiting:
+                _status_cache.release(job.job_id)
+        return results
+
+
+# (timestamp, value) of the last sinfo cpu count, reused for MAX_CPUS_TTL seconds
+MAX_CPUS_TTL = 60
+_max_cpus_cache = None
 
 
 def get_max_slurm_cpus():
     """get the max number of cpus for slurm"""
-    cmdout = run_shell_command("sinfo -h -o %C")
+    global _max_cpus_cache
+    now = time.monotonic()
+    if _max_cpus_cache is not None and now - _max_cpus_cache[0] < MAX_CPUS_TTL:
+        return _max_cpus_cache[1]
+
+    # only the first line is needed, so stop reading once it arrives
+    lines = []
+
+    def first_line(line):
+        lines.append(line)
+        return True
+
+    run_shell_command_stream("sinfo -h -o %C", first_line)
     try:
-        maxcores = int(cmdout.strip().split('/')[-1])
-    except AttributeError:
+        maxcores = int(lines[0].strip().split('/')[-1])
+    except (ValueError, IndexError):
         maxcores = 1
+    _max_cpus_cache = (now, maxcores)
     return maxcores
 
 
@@ -33,23 +33,40 @@ def reinstate_file_handlers(saved_handlers):
 
 
 # from https://stackoverflow.com/questions/21953835/run-subprocess-and-print-output-to-logging
-def run_shell_command(command_line, verbose=False):
+def run_shell_command_stream(command_line, on_line, verbose=False):
+    """
+    Run a command, passing each line of output to on_line as it is read.
+
+    Parameters:
+    -----------
+    command_line: str
+        command to run
+    on_line: callable
+        called with each line of output; if it returns True the command
+        is terminated and no further output is read
+
+    Returns False if an exception occurred, True otherwise.
+    """
     command_line_args = shlex.split(command_line)
 
     if verbose:
         logging.info('Subprocess: "' + command_line + '"')
 
     try:
-        command_line_process = subprocess.Popen(
+        with subprocess.Popen(
             command_line_args,
             stdout=subprocess.PIPE,
             # stderr=subprocess.STDOUT,
-        )
-
-        process_output, _ = command_line_process.communicate()
-
-        if verbose:
-            logging.info(f'got line from subprocess: {process_output.decode("utf-8")}')
+            bufsize=1,
+            text=True,
+            encoding='utf-8',
+        ) as command_line_process:
+            for line in command_line_process.stdout:
+                if verbose:
+                    logging.info(f'got line from subprocess: {line}')
+                if on_line(line):
+                    command_line_process.terminate()
+                    break
     except Exception as e:
         logging.error(f'Exception occured: {e}')
         return False
@@ -58,7 +75,14 @@ def run_shell_command(command_line, verbose=False):
         if verbose:
             logging.info('Subprocess finished')
 
-    return process_output.decode("utf-8")
+    return True
+
+
+def run_shell_command(command_line, verbose=False):
+    lines = []
+    if not run_shell_command_stream(command_line, lines.append, verbose):
+        return False
+    return ''.join(lines)
 
 
 def dict_to_namespace(d):
@@ -69,16 +93,32 @@ def dict_to_namespace(d):
     return args
 
 
+# convert a single key/value pair to command line args, keyed by value type
+_ARG_HANDLERS = {
+    bool: lambda k, v: [f"--{k}"] if v else [],
+    int: lambda k, v: [f"--{k}", str(v)],
+    float: lambda k, v: [f"--{k}", str(v)],
+    str: lambda k, v: [f"--{k}", v],
+    list: lambda k, v: [f"--{k}", *map(str, v)],
+}
+
+
+def _no_args(k, v):
+    # values of other types are not passed on the command line
+    return []
+
+
+def _arg_handler(value_type):
+    handler = _ARG_HANDLERS.get(value_type)
+    if handler is None:
+        # subclasses of the supported types use their base type's handler
+        handler = next(
+            (_ARG_HANDLERS[t] for t in value_type.__mro__ if t in _ARG_HANDLERS),
+            _no_args)
+        _ARG_HANDLERS[value_type] = handler
+    return handler
+
+
 def dict_to_args_list(d):
     # convert a dict to a set of command line args
-    argslist = []
-    for k, v in d.items():
-        if isinstance(v, bool):
-            if v:
-                argslist.append(f"--{k}")
-        elif isinstance(v, (int, float, str)):
-            argslist.extend((f"--{k}", f"{v}"))
-        elif isinstance(v, list):
-            argslist.append(f"--{k}")
-            argslist.extend(f"{vv}" for vv in v)
-    return argslist
+    return [arg for k, v in d.items() for arg in _arg_handler(type(v))(k, v)]
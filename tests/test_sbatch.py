@@ -3,10 +3,14 @@
 
 import sys
 import os
+import time
 import shutil
+import subprocess
 from pathlib import Path
 import logging  # noqa
-from brainsss2.slurm import SlurmBatchJob  # noqa
+from brainsss2.slurm import (  # noqa
+    SlurmBatchJob, JobPool, _StatusCache, _file_handler_users, logger
+)
 import pytest  # noqa
 
 
@@ -27,6 +31,35 @@ def test_sbatch_argdict():
     assert sbatch.args["foo"] == 1
 
 
+def test_sbatch_default_args_unchanged():
+    sbatch = SlurmBatchJob("test", "dummy_script.py", {"cores": 4})
+    assert sbatch.args["cores"] == 4
+    assert sbatch.default_args["cores"] == 1
+
+
+def test_sbatch_shared_file_handler():
+    jobs = [SlurmBatchJob("test", "dummy_script.py", {"foo": i},
+                          logfile='logs/shared_handler_test.log')
+            for i in range(2)]
+    handlers = [h for h in logger.handlers if isinstance(h, logging.FileHandler)
+                and h.baseFilename == os.path.realpath('logs/shared_handler_test.log')]
+    assert len(handlers) == 1
+    fh = handlers[0]
+    assert _file_handler_users[fh] == 2
+    jobs[0].close()
+    assert fh in logger.handlers
+    jobs[1].close()
+    assert fh not in logger.handlers
+    assert fh not in _file_handler_users
+    assert fh.stream is None
+
+
+def test_sbatch_missing_script():
+    sbatch = SlurmBatchJob("test", "missing_script.py", {})
+    with pytest.raises(FileNotFoundError):
+        sbatch.run()
+
+
 def test_sbatch_run(sbatch):
     sbatch.run()
     assert sbatch.job_id is not None
@@ -39,3 +72,153 @@ def test_sbatch_wait(sbatch):
     assert os.path.exists(sbatch.logfile)
     # find internal log file
     assert len(list(Path('logs').glob('dummy_script_test*'))) == 1
+
+
+def test_sbatch_run_many():
+    jobs = [SlurmBatchJob("test", "dummy_script.py", {"foo": i},
+                          logfile=f'logs/sbatch_test_{i}.log')
+            for i in range(3)]
+    SlurmBatchJob.run_many(jobs)
+    master_id = jobs[0].job_id.split('_')[0]
+    assert [job.job_id for job in jobs] == [f'{master_id}_{i}' for i in range(3)]
+    for job in jobs:
+        output = job.wait()
+        assert job.status() == "COMPLETED"
+        assert 'testing' in output
+    # the array leaves no task files or per-task logs behind
+    assert not list(Path('logs').glob('test_*'))
+
+
+def test_jobpool_wait_all():
+    pool = JobPool()
+    for i in range(2):
+        pool.submit(SlurmBatchJob("test", "dummy_script.py", {"foo": i},
+                                  logfile=f'logs/jobpool_test_{i}.log'))
+    results = pool.wait_all()
+    assert len(results) == 2
+    assert all(job.status() == "COMPLETED" for job in results)
+
+
+def test_jobpool_local_job():
+    pool = JobPool()
+    job = pool.submit(SlurmBatchJob("test", "dummy_script.py", {"foo": 1},
+                                    logfile='logs/jobpool_local_test.log',
+                                    local=True))
+    assert job.job_id is None
+    assert not job.sbatch_run
+    results = pool.wait_all()
+    assert results[job] is job.local_response
+    assert job.local_response.returncode == 0
+
+
+class FakeSqueue:
+    """stand-in for the squeue stream process, fed through a pipe"""
+
+    def __init__(self, *args, **kwargs):
+        read_fd, write_fd = os.pipe()
+        self.stdout = os.fdopen(read_fd)
+        self._writer = os.fdopen(write_fd, 'w')
+        self.terminated = False
+
+    def send(self, text):
+        self._writer.write(text)
+        self._writer.flush()
+
+    def terminate(self):
+        self.terminated = True
+        if not self._writer.closed:
+            self._writer.close()
+
+    def wait(self):
+        return 0
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def status_cache(monkeypatch):
+    processes = []
+
+    def popen(*args, **kwargs):
+        processes.append(FakeSqueue())
+        return processes[-1]
+
+    monkeypatch.setattr(subprocess, 'Popen', popen)
+    cache = _StatusCache()
+    yield cache, processes
+    for process in processes:
+        process.terminate()
+
+
+def test_status_cache_parses_stream(status_cache):
+    cache, processes = status_cache
+    cache.start('11')
+    processes[0].send(
+        'Wed Oct 15 12:00:00 2026\n'
+        'JOBID,STATE\n11,RUNNING\n12_3,pending\n\n')
+    wait_for(lambda: cache.get('12_3') is not None)
+    assert cache.get('11') == 'RUNNING'
+    assert cache.get('12_3') == 'PENDING'
+    assert cache.get('Wed Oct 15 12:00:00 2026') is None
+
+
+def test_status_cache_eof_releases_waiters(status_cache):
+    cache, processes = status_cache
+    cache.start('11')
+    processes[0].send('JOBID,STATE\n11,RUNNING\n\n')
+    wait_for(lambda: cache.get('11') is not None)
+    processes[0].terminate()
+    wait_for(lambda: not cache.running())
+    assert cache.get('11') is None
+
+
+def test_status_cache_wakes_waiter(status_cache):
+    cache, processes = status_cache
+    cache.start('11')
+    processes[0].send('JOBID,STATE\n11,RUNNING\n\n')
+    wait_for(lambda: cache.get('11') is not None)
+    # the job leaves the queue before the waiter starts waiting
+    processes[0].send('JOBID,STATE\n\n')
+    wait_for(lambda: cache.get('11') is None)
+    start = time.monotonic()
+    cache.wait('11', 10)
+    assert time.monotonic() - start < 5
+
+
+def test_status_cache_wakes_on_finished_state(status_cache):
+    cache, processes = status_cache
+    cache.start('11')
+    processes[0].send('JOBID,STATE\n11,RUNNING\n\n')
+    wait_for(lambda: cache.get('11') is not None)
+    processes[0].send('JOBID,STATE\n11,FAILED\n\n')
+    start = time.monotonic()
+    cache.wait('11', 10)
+    assert time.monotonic() - start < 5
+    assert cache.get('11') == 'FAILED'
+
+
+def test_status_cache_release_stops_stream(status_cache):
+    cache, processes = status_cache
+    cache.start('11')
+    cache.start('12')
+    assert len(processes) == 1
+    cache.release('11')
+    assert not processes[0].terminated
+    cache.release('12')
+    assert processes[0].terminated
+    assert not cache.running()
+
+
+def test_status_cache_restarts_dead_stream(status_cache):
+    cache, processes = status_cache
+    cache.start('11')
+    processes[0].terminate()
+    wait_for(lambda: not cache.running())
+    cache.start('12')
+    assert len(processes) == 2
+    assert cache.running()